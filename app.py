@@ -1,7 +1,8 @@
 from fastapi.staticfiles import StaticFiles
 from pathlib import Path
-import os, json, logging, requests
+import os, json, logging, requests, asyncio, threading
 from typing import Dict, Any
+from contextlib import asynccontextmanager
 from pathlib import Path
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.responses import JSONResponse, FileResponse, HTMLResponse
@@ -10,6 +11,8 @@ import stripe
 from products_config import PRODUCTS, ATTACHMENT_SIZE_LIMIT
 from token_links import make_signed_link, verify_token
 from email_sender import send_customer_email  # Only email, no Discord
+from notifier import send_admin_alert
+from event_poller import EventPoller, EventStateStore, DEFAULT_STATE_FILE
 
 load_dotenv()
 
@@ -17,13 +20,53 @@ load_dotenv()
 STRIPE_SECRET_KEY = os.getenv("STRIPE_API_KEY", "")
 STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET", "")
 APP_BASE_URL = os.getenv("APP_BASE_URL", "http://localhost:8000")
+STRIPE_API_BASE = os.getenv("STRIPE_API_BASE", "")  # e.g. http://localhost:12111 for stripe-mock
+STRIPE_EVENT_POLLING = os.getenv("STRIPE_EVENT_POLLING", "").lower() in ("1", "true", "yes")
+# Must be on a persistent volume, or every redeploy forgets what was delivered
+STRIPE_POLL_STATE_FILE = os.getenv("STRIPE_POLL_STATE_FILE", DEFAULT_STATE_FILE)
+POLLER_SHUTDOWN_TIMEOUT = 10
 
 stripe.api_key = STRIPE_SECRET_KEY or None
+if STRIPE_API_BASE:
+    stripe.api_base = STRIPE_API_BASE
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("stripe-fulfillment")
 
-app = FastAPI(title="Stripe Digital Delivery")
+# Durable record of delivered events; only kept when polling is on
+EVENT_STATE = EventStateStore(STRIPE_POLL_STATE_FILE) if STRIPE_EVENT_POLLING else None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # --- Events API polling (optional complement to the webhook) ---
+    if not STRIPE_EVENT_POLLING:
+        yield
+        return
+    if not STRIPE_SECRET_KEY:
+        raise RuntimeError("STRIPE_EVENT_POLLING is on but STRIPE_API_KEY is empty")
+    try:
+        EVENT_STATE.check_writable()
+    except OSError as e:
+        raise RuntimeError(
+            f"STRIPE_EVENT_POLLING is on but poller state {EVENT_STATE.path} is not writable "
+            f"(mount a persistent volume there or set STRIPE_POLL_STATE_FILE): {e}"
+        )
+
+    stop = asyncio.Event()
+    poller = EventPoller(handle_event=fulfill_event, store=EVENT_STATE, on_dead_letter=alert_dead_letter)
+    task = asyncio.create_task(poller.run(stop))
+    log.info("Stripe event poller started (state file: %s)", EVENT_STATE.path)
+    try:
+        yield
+    finally:
+        stop.set()
+        poller.stop()
+        try:
+            await asyncio.wait_for(task, timeout=POLLER_SHUTDOWN_TIMEOUT)
+        except asyncio.TimeoutError:
+            log.warning("Event poller still busy after %ss; shutting down without it", POLLER_SHUTDOWN_TIMEOUT)
+
+app = FastAPI(title="Stripe Digital Delivery", lifespan=lifespan)
 
 # Create static directory if it doesn't exist
 static_dir = Path("static")
@@ -32,7 +75,9 @@ static_dir.mkdir(exist_ok=True)
 # Mount static files
 app.mount("/static", StaticFiles(directory="static"), name="static")
 # Simple in-memory idempotency (replace with Redis/DB in prod)
+# Locked because the event poller fulfills from a worker thread.
 SEEN_EVENTS = set()
+SEEN_LOCK = threading.Lock()
 
 @app.get("/")
 def health():
@@ -174,24 +219,43 @@ def deduplicate_deliverables(deliverables):
     
     return unique_deliverables
 
-@app.post("/stripe/webhook")
-async def stripe_webhook(request: Request):
-    payload = await request.body()
-    sig_header = request.headers.get("stripe-signature")
-    try:
-        event = stripe.Webhook.construct_event(
-            payload=payload, sig_header=sig_header, secret=STRIPE_WEBHOOK_SECRET
-        )
-    except stripe.error.SignatureVerificationError:
-        raise HTTPException(status_code=400, detail="Invalid signature")
-    except Exception:
-        raise HTTPException(status_code=400, detail="Invalid payload")
+class EmailDeliveryError(Exception):
+    pass
+
+def claim_event(event_id) -> bool:
+    """Mark an event as in-flight. False if the webhook or poller already has it."""
+    with SEEN_LOCK:
+        if event_id in SEEN_EVENTS:
+            return False
+        if EVENT_STATE is not None and EVENT_STATE.is_handled(event_id):
+            return False
+        SEEN_EVENTS.add(event_id)
+        return True
+
+def release_event(event_id):
+    """Forget a failed event so a Stripe retry (or the next poll) can try again."""
+    with SEEN_LOCK:
+        SEEN_EVENTS.discard(event_id)
 
+def fulfill_event(event) -> Dict[str, Any]:
+    """Deliver downloads for a Stripe event. Shared by the webhook and the poller.
+
+    Raises EmailDeliveryError if the customer email could not be sent; on any
+    failure the event is released from SEEN_EVENTS so it can be retried.
+    """
     event_id = event.get("id")
-    if event_id in SEEN_EVENTS:
-        return JSONResponse({"ok": True, "idempotent": True})
-    SEEN_EVENTS.add(event_id)
+    if not claim_event(event_id):
+        return {"ok": True, "idempotent": True}
+    try:
+        result = _fulfill(event)
+    except Exception:
+        release_event(event_id)
+        raise
+    if EVENT_STATE is not None:
+        EVENT_STATE.mark_handled(event_id)
+    return result
 
+def _fulfill(event) -> Dict[str, Any]:
     event_type = event.get("type")
     log.info(f"▶️ Stripe event: {event_type}")
 
@@ -207,7 +271,7 @@ async def stripe_webhook(request: Request):
         
         if not customer_email:
             log.warning("No customer email found; skipping.")
-            return JSONResponse({"ok": True, "note": "no customer email"})
+            return {"ok": True, "note": "no customer email"}
 
         product_ids = extract_product_ids(event)
         deliverables = pick_deliverables(product_ids)
@@ -220,7 +284,7 @@ async def stripe_webhook(request: Request):
         
         if not deliverables:
             log.warning(f"No configured deliverables for IDs: {product_ids}")
-            return JSONResponse({"ok": True, "note": "no deliverables matched"})
+            return {"ok": True, "note": "no deliverables matched"}
 
         # Build download links
         enriched = []
@@ -246,24 +310,78 @@ async def stripe_webhook(request: Request):
                 deliverables=enriched,
                 order_id=order_id
             )
-            
-            if email_sent:
-                log.info("✅ Email sent successfully to %s with %d unique items", customer_email, len(enriched))
-                return JSONResponse({
-                    "ok": True, 
-                    "email_sent": True,
-                    "customer": customer_email,
-                    "items": len(enriched)
-                })
-            else:
-                log.error("❌ Failed to send email to %s", customer_email)
-                raise HTTPException(status_code=500, detail="Email delivery failed")
-                
         except Exception as e:
-            log.exception("Email sending failed: %s", e)
-            raise HTTPException(status_code=500, detail=f"Email error: {e}")
+            raise EmailDeliveryError(str(e)) from e
+        
+        if not email_sent:
+            log.error("❌ Failed to send email to %s", customer_email)
+            raise EmailDeliveryError("Email delivery failed")
+
+        log.info("✅ Email sent successfully to %s with %d unique items", customer_email, len(enriched))
+        return {
+            "ok": True, 
+            "email_sent": True,
+            "customer": customer_email,
+            "items": len(enriched)
+        }
 
-    return JSONResponse({"ok": True})
+    return {"ok": True}
+
+@app.post("/stripe/webhook")
+async def stripe_webhook(request: Request):
+    payload = await request.body()
+    sig_header = request.headers.get("stripe-signature")
+    try:
+        event = stripe.Webhook.construct_event(
+            payload=payload, sig_header=sig_header, secret=STRIPE_WEBHOOK_SECRET
+        )
+    except stripe.error.SignatureVerificationError:
+        raise HTTPException(status_code=400, detail="Invalid signature")
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid payload")
+
+    try:
+        return JSONResponse(fulfill_event(event))
+    except EmailDeliveryError as e:
+        log.exception("Email sending failed: %s", e)
+        raise HTTPException(status_code=500, detail=f"Email error: {e}")
+    except Exception as e:
+        log.exception("Fulfillment failed: %s", e)
+        raise HTTPException(status_code=500, detail="Fulfillment failed")
+
+def alert_dead_letter(event_id: str, error: Exception):
+    """Poller gave up on a paid order; tell a human how to redeliver it."""
+    send_admin_alert(
+        title="Order not delivered — poller gave up",
+        description=(
+            f"Event `{event_id}` failed every retry: {error}\n"
+            f"Redeliver with POST {APP_BASE_URL.rstrip('/')}/_debug/redeliver/{event_id} "
+            "or Resend the event from the Stripe dashboard."
+        ),
+    )
+
+@app.get("/_debug/dead-letters")
+def list_dead_letters():
+    """Events the poller gave up on (still deliverable via webhook or redeliver)"""
+    if EVENT_STATE is None:
+        return {"polling": False, "dead_letter": []}
+    return {"polling": True, "dead_letter": EVENT_STATE.dead_letters()}
+
+@app.post("/_debug/redeliver/{event_id}")
+def redeliver_event(event_id: str):
+    """Re-run fulfillment for a Stripe event (no-op if already delivered)"""
+    try:
+        event = stripe.Event.retrieve(event_id)
+    except stripe.error.InvalidRequestError:
+        raise HTTPException(status_code=404, detail="Unknown event")
+    try:
+        return fulfill_event(event)
+    except EmailDeliveryError as e:
+        log.exception("Email sending failed: %s", e)
+        raise HTTPException(status_code=500, detail=f"Email error: {e}")
+    except Exception as e:
+        log.exception("Fulfillment failed: %s", e)
+        raise HTTPException(status_code=500, detail="Fulfillment failed")
 
 @app.get("/download/{token}")
 async def download_with_token(token: str):
@@ -0,0 +1,286 @@
+# event_poller.py - pull missed checkout events from the Stripe Events API
+#
+# The webhook is still the primary path. This poller pages through
+# `checkout.session.completed` events newer than a saved cursor and hands each
+# one to the same fulfillment function. Which events were already delivered
+# (by either path) is kept in a state file, so restarts don't re-send email.
+# That file must live on a persistent volume (see STRIPE_POLL_STATE_FILE).
+#
+# Events the poller gives up on are listed under "dead_letter" in the state
+# file (also GET /_debug/dead-letters). Dead-lettering only moves the poller's
+# cursor: a Stripe webhook retry, "Resend" in the Stripe dashboard, or
+# POST /_debug/redeliver/{event_id} still delivers them.
+import os, json, time, asyncio, logging, threading
+from typing import Any, Callable, Dict, List, Optional
+import stripe
+
+log = logging.getLogger("event_poller")
+
+EVENT_TYPE = "checkout.session.completed"
+PAGE_LIMIT = 100          # Stripe's maximum page size
+HANDLED_KEEP = 5000       # handled ids remembered; far more than one cursor gap
+DEAD_LETTER_KEEP = 500
+DEFAULT_STATE_FILE = "data/stripe_event_state.json"
+
+
+class EventStateStore:
+    """Durable poller state: cursor, handled event ids, failure counts, dead letters.
+
+    Shared by the webhook and the poller. Writes are atomic (tmp + rename).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._state = self._load()
+
+    def _load(self) -> Dict[str, Any]:
+        state: Dict[str, Any] = {}
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log.warning("Unreadable poller state %s: %s", self.path, e)
+        state.setdefault("cursor", None)
+        state.setdefault("since", None)
+        state.setdefault("handled", [])
+        state.setdefault("failures", {})
+        state.setdefault("dead_letter", [])
+        return state
+
+    def _write(self) -> None:
+        parent = os.path.dirname(self.path)
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self._state, f)
+        os.replace(tmp, self.path)
+
+    def _save(self) -> None:
+        try:
+            self._write()
+        except OSError as e:
+            log.error("Could not persist poller state to %s: %s", self.path, e)
+
+    def check_writable(self) -> None:
+        """Raise OSError now rather than losing state after every page later."""
+        with self._lock:
+            self._write()
+
+    @property
+    def cursor(self) -> Optional[str]:
+        return self._state["cursor"]
+
+    @property
+    def since(self) -> Optional[int]:
+        return self._state["since"]
+
+    def set_cursor(self, event_id: Optional[str], since: Optional[int] = None) -> None:
+        with self._lock:
+            self._state["cursor"] = event_id
+            self._state["since"] = since
+            self._save()
+
+    def is_handled(self, event_id: str) -> bool:
+        """True once the customer email for this event has gone out."""
+        with self._lock:
+            return event_id in self._state["handled"]
+
+    def is_dead_lettered(self, event_id: str) -> bool:
+        with self._lock:
+            return event_id in self._state["dead_letter"]
+
+    def dead_letters(self) -> List[str]:
+        with self._lock:
+            return list(self._state["dead_letter"])
+
+    def mark_handled(self, event_id: str, cursor: Optional[str] = None) -> None:
+        with self._lock:
+            handled = self._state["handled"]
+            if event_id not in handled:
+                handled.append(event_id)
+                del handled[:-HANDLED_KEEP]
+            self._state["failures"].pop(event_id, None)
+            if event_id in self._state["dead_letter"]:
+                self._state["dead_letter"].remove(event_id)
+            if cursor:
+                self._state["cursor"] = cursor
+                self._state["since"] = None
+            self._save()
+
+    def record_failure(self, event_id: str) -> int:
+        with self._lock:
+            count = self._state["failures"].get(event_id, 0) + 1
+            self._state["failures"][event_id] = count
+            self._save()
+            return count
+
+    def dead_letter(self, event_id: str, cursor: str) -> None:
+        with self._lock:
+            dead = self._state["dead_letter"]
+            if event_id not in dead:
+                dead.append(event_id)
+            del dead[:-DEAD_LETTER_KEEP]
+            self._state["failures"].pop(event_id, None)
+            self._state["cursor"] = cursor
+            self._state["since"] = None
+            self._save()
+
+
+class EventPoller:
+    """Feed `checkout.session.completed` events into `handle_event`, oldest first.
+
+    `list_events` defaults to `stripe.Event.list`; pass any callable with the
+    same params/response shape to run against a local Events API stand-in.
+    """
+
+    def __init__(
+        self,
+        handle_event: Callable[[Any], Dict],
+        store: EventStateStore,
+        list_events: Optional[Callable[..., Any]] = None,
+        min_interval: Optional[float] = None,
+        max_interval: Optional[float] = None,
+        max_attempts: Optional[int] = None,
+        on_dead_letter: Optional[Callable[[str, Exception], Any]] = None,
+    ):
+        self.handle_event = handle_event
+        self.store = store
+        self.list_events = list_events or stripe.Event.list
+        self.min_interval = min_interval if min_interval is not None else float(os.getenv("STRIPE_POLL_MIN_SECONDS", "15"))
+        self.max_interval = max_interval if max_interval is not None else float(os.getenv("STRIPE_POLL_MAX_SECONDS", "300"))
+        # Attempts per event before it is dead-lettered and the cursor moves on
+        self.max_attempts = max_attempts if max_attempts is not None else int(os.getenv("STRIPE_POLL_MAX_ATTEMPTS", "5"))
+        self.on_dead_letter = on_dead_letter
+        self.interval = self.min_interval
+        self._stopping = threading.Event()
+
+    def stop(self) -> None:
+        """Ask an in-flight `poll_once` (in its worker thread) to return early."""
+        self._stopping.set()
+
+    def poll_once(self) -> int:
+        """Fetch and handle everything newer than the cursor. Returns new events seen."""
+        if self.store.cursor is None:
+            if self.store.since is None:
+                self._seed()
+                return 0
+            return self._since_seed()
+
+        seen = 0
+        while not self._stopping.is_set():
+            try:
+                page = self.list_events(type=EVENT_TYPE, limit=PAGE_LIMIT, ending_before=self.store.cursor)
+            except stripe.error.InvalidRequestError as e:
+                # Cursor event aged out of Stripe's 30-day window (or never existed)
+                log.warning("Cursor %s rejected (%s); re-seeding from newest event", self.store.cursor, e)
+                self._seed()
+                return seen
+
+            # Pages are newest-first; `ending_before` walks toward newer events
+            events = list(page.get("data", []))
+            if not events:
+                return seen
+            seen += self._handle_batch(list(reversed(events)))
+            if not page.get("has_more") or self.store.cursor != events[0]["id"]:
+                # Done, or the batch stopped early (failure, in-flight, shutdown)
+                return seen
+        return seen
+
+    def _seed(self) -> None:
+        """Cold start: adopt the newest existing event as the cursor, fulfilling nothing.
+
+        Older events were the webhook's job; we can't prove they weren't delivered.
+        """
+        now = int(time.time())
+        page = self.list_events(type=EVENT_TYPE, limit=1)
+        data = list(page.get("data", []))
+        if data:
+            self.store.set_cursor(data[0]["id"])
+            log.info("Poller cursor seeded at %s; older events are left to the webhook", data[0]["id"])
+        else:
+            # No events yet: remember when we started so the first one isn't skipped
+            self.store.set_cursor(None, since=now)
+            log.info("No %s events yet; poller will pick up events from now on", EVENT_TYPE)
+
+    def _since_seed(self) -> int:
+        """Seeded with no events: handle anything created since, oldest-first."""
+        events: List[Any] = []
+        starting_after = None
+        while True:
+            params: Dict[str, Any] = {"type": EVENT_TYPE, "limit": PAGE_LIMIT, "created": {"gte": self.store.since}}
+            if starting_after:
+                params["starting_after"] = starting_after
+            page = self.list_events(**params)
+            data = list(page.get("data", []))
+            events.extend(data)
+            if not data or not page.get("has_more"):
+                break
+            starting_after = data[-1]["id"]
+        return self._handle_batch(list(reversed(events)))
+
+    def _handle_batch(self, events: List[Any]) -> int:
+        """Handle events in order, advancing the cursor past each one.
+
+        A failing event stops the batch so it is retried next poll (it still
+        counts as seen, so the retry isn't slowed by idle backoff); after
+        `max_attempts` failures it is dead-lettered and the cursor moves on.
+        """
+        seen = 0
+        for event in events:
+            if self._stopping.is_set():
+                break
+            event_id = event["id"]
+            seen += 1
+            if self.store.is_handled(event_id) or self.store.is_dead_lettered(event_id):
+                self.store.set_cursor(event_id)
+                continue
+            try:
+                result = self.handle_event(event)
+            except Exception as e:
+                attempts = self.store.record_failure(event_id)
+                if attempts < self.max_attempts:
+                    log.warning("Event %s failed (attempt %d/%d): %s", event_id, attempts, self.max_attempts, e)
+                    break
+                log.error("Giving up on event %s after %d attempts; dead-lettered: %s", event_id, attempts, e)
+                self.store.dead_letter(event_id, cursor=event_id)
+                if self.on_dead_letter:
+                    try:
+                        self.on_dead_letter(event_id, e)
+                    except Exception:
+                        log.exception("Dead-letter alert failed for %s", event_id)
+                continue
+            if result.get("idempotent"):
+                # The webhook has it in flight; look again next poll
+                break
+            self.store.mark_handled(event_id, cursor=event_id)
+            log.info("Polled event %s handled", event_id)
+        return seen
+
+    def next_interval(self, seen: int) -> float:
+        """Poll fast while new events are arriving, back off (x2) while idle.
+
+        `run` also backs off when listing events fails; a failing handler
+        does not, since `_handle_batch` counts the failed event as seen.
+        """
+        if seen:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * 2, self.max_interval)
+        return self.interval
+
+    async def run(self, stop: asyncio.Event) -> None:
+        while not stop.is_set():
+            try:
+                seen = await asyncio.to_thread(self.poll_once)
+                delay = self.next_interval(seen)
+            except Exception as e:
+                log.exception("Event poll failed: %s", e)
+                delay = self.next_interval(0)
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
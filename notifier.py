@@ -63,3 +63,7 @@ def send_fulfillment_card(
     lines += ["", "Links expire in 1 hour. If a link times out, reply and I’ll refresh it.", "Best,\nLead Generator Empire"]
     fields.append({"name": "Customer Email Template", "value": "\n".join(lines), "inline": False})
     return _send_any(mode, title, desc, fields, 3066993)
+
+def send_admin_alert(title: str, description: str, fields: Optional[List[Dict]] = None) -> bool:
+    """Red card to the admin channel for things a human has to act on."""
+    return _send_any("admin", title, description, fields or [], 15158332)
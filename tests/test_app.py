@@ -0,0 +1,108 @@
+import os, sys, asyncio
+import pytest
+import stripe
+from fastapi import HTTPException
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app
+from event_poller import EventPoller, EventStateStore
+
+PRICE_ID = next(iter(app.PRODUCTS))
+
+
+def checkout_event(event_id):
+    return {
+        "id": event_id,
+        "type": "checkout.session.completed",
+        "data": {"object": {"id": f"cs_{event_id}", "customer_details": {"email": "buyer@example.com"}}},
+    }
+
+
+class Mailer:
+    def __init__(self):
+        self.sent = []
+        self.result = True
+        self.error = None
+
+    def __call__(self, customer_email, deliverables, order_id=None):
+        if self.error:
+            raise self.error
+        if self.result:
+            self.sent.append(order_id)
+        return self.result
+
+
+@pytest.fixture
+def mailer(monkeypatch, tmp_path):
+    m = Mailer()
+    monkeypatch.setattr(app, "send_customer_email", m)
+    monkeypatch.setattr(app, "extract_product_ids", lambda event: [PRICE_ID])
+    monkeypatch.setattr(app, "EVENT_STATE", EventStateStore(str(tmp_path / "state.json")))
+    monkeypatch.setattr(app, "SEEN_EVENTS", set())
+    return m
+
+
+class FakeRequest:
+    headers = {"stripe-signature": "t=1,v1=sig"}
+
+    async def body(self):
+        return b"{}"
+
+
+def post_webhook(monkeypatch, event):
+    monkeypatch.setattr(stripe.Webhook, "construct_event", lambda **kw: event)
+    return asyncio.run(app.stripe_webhook(FakeRequest()))
+
+
+def test_webhook_is_idempotent_after_poller_delivered(mailer, monkeypatch):
+    event = checkout_event("evt_polled")
+    poller = EventPoller(app.fulfill_event, app.EVENT_STATE,
+                         list_events=lambda **kw: {"data": [], "has_more": False})
+    poller._handle_batch([event])
+    assert mailer.sent == ["cs_evt_polled"]
+
+    # Restart: in-memory SEEN_EVENTS is gone, the state file is not
+    monkeypatch.setattr(app, "SEEN_EVENTS", set())
+    post_webhook(monkeypatch, event)
+    assert mailer.sent == ["cs_evt_polled"]
+    assert app.fulfill_event(event) == {"ok": True, "idempotent": True}
+
+
+def test_webhook_still_delivers_dead_lettered_event(mailer, monkeypatch):
+    app.EVENT_STATE.dead_letter("evt_dead", cursor="evt_dead")
+
+    post_webhook(monkeypatch, checkout_event("evt_dead"))
+    assert mailer.sent == ["cs_evt_dead"]
+    assert app.EVENT_STATE.is_handled("evt_dead")
+    assert app.EVENT_STATE.dead_letters() == []
+
+
+def test_failed_delivery_is_released_and_retry_succeeds(mailer, monkeypatch):
+    event = checkout_event("evt_retry")
+    mailer.result = False
+    with pytest.raises(HTTPException) as exc:
+        post_webhook(monkeypatch, event)
+    assert exc.value.status_code == 500
+    assert exc.value.detail == "Email error: Email delivery failed"
+    assert "evt_retry" not in app.SEEN_EVENTS
+    assert not app.EVENT_STATE.is_handled("evt_retry")
+
+    mailer.result = True
+    post_webhook(monkeypatch, event)
+    assert mailer.sent == ["cs_evt_retry"]
+    assert app.EVENT_STATE.is_handled("evt_retry")
+
+
+def test_email_exception_keeps_email_error_detail(mailer, monkeypatch):
+    mailer.error = ConnectionError("SMTP down")
+    with pytest.raises(HTTPException) as exc:
+        post_webhook(monkeypatch, checkout_event("evt_smtp"))
+    assert exc.value.detail == "Email error: SMTP down"
+
+
+def test_other_failures_get_generic_500(mailer, monkeypatch):
+    with pytest.raises(HTTPException) as exc:
+        post_webhook(monkeypatch, {"id": "evt_bad", "type": "checkout.session.completed"})
+    assert exc.value.status_code == 500
+    assert exc.value.detail == "Fulfillment failed"
+    assert "evt_bad" not in app.SEEN_EVENTS
@@ -0,0 +1,211 @@
+import os, sys, asyncio
+import pytest
+import stripe
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from event_poller import EventPoller, EventStateStore, PAGE_LIMIT
+
+
+class FakeEventsAPI:
+    """Local stand-in for `stripe.Event.list` (newest-first pages, Stripe cursor semantics)."""
+
+    def __init__(self):
+        self.events = []  # oldest first
+        self.calls = []
+
+    def add(self, n, created=1000):
+        start = len(self.events)
+        for i in range(start, start + n):
+            self.events.append({"id": f"evt_{i:04d}", "type": "checkout.session.completed", "created": created})
+
+    def __call__(self, type=None, limit=10, ending_before=None, starting_after=None, created=None):
+        self.calls.append({"ending_before": ending_before, "starting_after": starting_after})
+        newest_first = list(reversed(self.events))
+        if created:
+            newest_first = [e for e in newest_first if e["created"] >= created["gte"]]
+        ids = [e["id"] for e in newest_first]
+        if ending_before:
+            if ending_before not in ids:
+                raise stripe.error.InvalidRequestError("No such event", "ending_before")
+            newer = newest_first[:ids.index(ending_before)]
+            page = newer[-limit:]
+            return {"data": page, "has_more": len(newer) > len(page)}
+        start = ids.index(starting_after) + 1 if starting_after else 0
+        page = newest_first[start:start + limit]
+        return {"data": page, "has_more": start + limit < len(newest_first)}
+
+
+class Fulfiller:
+    def __init__(self, fail_ids=()):
+        self.fail_ids = set(fail_ids)
+        self.delivered = []
+
+    def __call__(self, event):
+        if event["id"] in self.fail_ids:
+            raise RuntimeError("Email delivery failed")
+        self.delivered.append(event["id"])
+        return {"ok": True, "email_sent": True}
+
+
+@pytest.fixture
+def state_path(tmp_path):
+    return str(tmp_path / "data" / "state.json")
+
+
+def make_poller(api, fulfill, state_path, **kw):
+    return EventPoller(fulfill, EventStateStore(state_path), list_events=api,
+                       min_interval=1, max_interval=8, **kw)
+
+
+def test_cold_start_seeds_cursor_without_fulfilling(state_path):
+    api = FakeEventsAPI()
+    api.add(5)
+    fulfill = Fulfiller()
+    poller = make_poller(api, fulfill, state_path)
+
+    assert poller.poll_once() == 0
+    assert fulfill.delivered == []
+    assert poller.store.cursor == "evt_0004"
+
+    api.add(2)
+    assert poller.poll_once() == 2
+    assert fulfill.delivered == ["evt_0005", "evt_0006"]
+
+
+def test_pages_across_has_more_oldest_first_and_cursor_survives_restart(state_path):
+    api = FakeEventsAPI()
+    api.add(1)
+    fulfill = Fulfiller()
+    make_poller(api, fulfill, state_path).poll_once()
+
+    api.add(2 * PAGE_LIMIT + 50)
+    assert make_poller(api, fulfill, state_path).poll_once() == 2 * PAGE_LIMIT + 50
+    assert fulfill.delivered == [e["id"] for e in api.events[1:]]
+    assert all(c["ending_before"] for c in api.calls[1:])
+
+    # Restart: reloaded cursor is the newest event, nothing is re-sent
+    restarted = make_poller(api, fulfill, state_path)
+    assert restarted.store.cursor == api.events[-1]["id"]
+    assert restarted.poll_once() == 0
+    assert len(fulfill.delivered) == 2 * PAGE_LIMIT + 50
+
+
+def test_events_handled_by_webhook_are_not_resent_after_restart(state_path):
+    api = FakeEventsAPI()
+    api.add(1)
+    fulfill = Fulfiller()
+    make_poller(api, fulfill, state_path).poll_once()
+
+    # Webhook delivers two events before the poller's cursor catches up
+    api.add(3)
+    EventStateStore(state_path).mark_handled("evt_0001")
+    EventStateStore(state_path).mark_handled("evt_0002")
+
+    poller = make_poller(api, fulfill, state_path)
+    assert poller.poll_once() == 3
+    assert fulfill.delivered == ["evt_0003"]
+    assert poller.store.cursor == "evt_0003"
+
+
+def test_rejected_cursor_reseeds_without_fulfilling(state_path):
+    api = FakeEventsAPI()
+    api.add(3)
+    EventStateStore(state_path).set_cursor("evt_gone")
+    fulfill = Fulfiller()
+    poller = make_poller(api, fulfill, state_path)
+
+    poller.poll_once()
+    assert fulfill.delivered == []
+    assert poller.store.cursor == "evt_0002"
+
+
+def test_no_events_at_seed_picks_up_the_first_one(state_path, monkeypatch):
+    monkeypatch.setattr("event_poller.time.time", lambda: 1000)
+    api = FakeEventsAPI()
+    fulfill = Fulfiller()
+    poller = make_poller(api, fulfill, state_path)
+
+    poller.poll_once()
+    assert poller.store.cursor is None
+
+    api.add(2, created=1005)
+    assert poller.poll_once() == 2
+    assert fulfill.delivered == ["evt_0000", "evt_0001"]
+    assert poller.store.cursor == "evt_0001"
+
+
+def test_failing_event_is_retried_then_dead_lettered(state_path):
+    api = FakeEventsAPI()
+    api.add(1)
+    fulfill = Fulfiller(fail_ids={"evt_0002"})
+    poller = make_poller(api, fulfill, state_path, max_attempts=3)
+    poller.poll_once()
+    api.add(3)
+
+    for _ in range(2):
+        seen = poller.poll_once()
+        assert poller.store.cursor == "evt_0001"
+        # A failed delivery is activity, not idleness: retry at min_interval
+        assert poller.next_interval(seen) == 1
+    assert fulfill.delivered == ["evt_0001"]
+
+    # Third failure: skip it so later orders still get recovered
+    alerts = []
+    poller.on_dead_letter = lambda event_id, e: alerts.append(event_id)
+    poller.poll_once()
+    assert fulfill.delivered == ["evt_0001", "evt_0003"]
+    assert poller.store.cursor == "evt_0003"
+    assert alerts == ["evt_0002"]
+    store = EventStateStore(state_path)
+    assert store.is_dead_lettered("evt_0002")
+    assert not store.is_handled("evt_0002")
+
+    # A later successful delivery (webhook retry) clears the dead letter
+    store.mark_handled("evt_0002")
+    assert store.dead_letters() == []
+
+
+def test_in_flight_event_does_not_advance_cursor(state_path):
+    api = FakeEventsAPI()
+    api.add(1)
+    poller = make_poller(api, lambda e: {"ok": True, "idempotent": True}, state_path)
+    poller.poll_once()
+    api.add(2)
+
+    poller.poll_once()
+    assert poller.store.cursor == "evt_0000"
+
+
+def test_list_events_error_backs_off(state_path):
+    api = FakeEventsAPI()
+    api.add(1)
+    poller = make_poller(api, Fulfiller(), state_path)
+    poller.poll_once()
+
+    def down(**kw):
+        raise stripe.error.APIConnectionError("down")
+
+    poller.list_events = down
+    stop = asyncio.Event()
+
+    async def go():
+        task = asyncio.create_task(poller.run(stop))
+        await asyncio.sleep(0.05)
+        stop.set()
+        await task
+
+    asyncio.run(go())
+    assert poller.interval == 2
+
+
+def test_interval_backs_off_when_idle_and_resets_on_activity(state_path):
+    poller = make_poller(FakeEventsAPI(), Fulfiller(), state_path)
+    assert [poller.next_interval(0) for _ in range(4)] == [2, 4, 8, 8]
+    assert poller.next_interval(3) == 1
+
+
+def test_unwritable_state_fails_loudly(tmp_path):
+    blocker = tmp_path / "file"
+    blocker.write_text("")
+    with pytest.raises(OSError):
+        EventStateStore(str(blocker / "state.json")).check_writable()